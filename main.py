@@ -1,22 +1,154 @@
-import spotipy, os, random, re, math
+import spotipy, requests, os, sys, random, re, math, time, threading, functools, shelve, heapq
 from spotipy.oauth2 import SpotifyClientCredentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from collections import Counter
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, responses are decoded with the standard json module without it
+    orjson = None
 
 load_dotenv()
 
+# Maximum number of artist IDs accepted by a single request to Spotify's several-artists endpoint
+ARTIST_BATCH_SIZE = 50
+# Maximum number of tracks returned by a single request for the items of a playlist
+PLAYLIST_PAGE_SIZE = 100
+# Only the parts of each playlist item that are used, to keep responses small
+PLAYLIST_ITEM_FIELDS = 'items(track(name,popularity,artists(name,id),album(name,release_date)))'
+# File that remembers artist genres between runs, and how long (in seconds) its entries stay valid
+GENRE_CACHE_PATH = '.genre_cache'
+GENRE_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+# Maximum number of Spotify API requests in flight at once
+MAX_WORKERS = 8
+# Sustained number of Spotify API requests allowed per second
+REQUESTS_PER_SECOND = 10
+# Number of attempts made for a request that Spotify keeps rate limiting (HTTP 429)
+MAX_ATTEMPTS = 5
+# Number of times a request is retried after a connection error or a server error (HTTP 5xx)
+SESSION_RETRIES = 5
+# Regular expression pattern to match a Spotify playlist URL, capturing the playlist ID
+SPOTIFY_PLAYLIST_REGEX = re.compile(r'^https://open\.spotify\.com/playlist/([a-zA-Z0-9_-]+)(?:\?si=[a-zA-Z0-9_-]+)?$')
+
+@dataclass(slots=True)
+class Track:
+    """
+    Information about a track in a playlist.
+    """
+    name: str
+    artists: list
+    artist_ids: list
+    popularity: int
+    release_year: int | None
+    album: str
+    # add list of genres found in particular track to be used for calculating genre cohension
+
+class RateLimiter:
+    """
+    Thread-safe leaky-bucket rate limiter.
+    Allows bursts of up to `rate` requests, then spaces requests out to `rate` per second.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Add the tokens that have leaked back in since the last refill. Must be called with the lock held.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Block until another request may be sent.
+        """
+        with self.lock:
+            self.refill()
+            # Reserve a token; once the bucket is empty each caller waits for its own refill
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hold back every caller for at least `seconds`, e.g. while Spotify is rate limiting requests.
+        """
+        with self.lock:
+            self.refill()
+            # Drain the bucket far enough that the next token only becomes available after the pause
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+
+def call_spotify(request, *args, **kwargs):
+    """
+    Make a Spotify API request through the shared rate limiter.
+    Retries while Spotify responds with HTTP 429, pausing the rate limiter for every thread until its Retry-After
+    header has passed, or backing off exponentially without one.
+    A 429 without response headers is spotipy reporting that the HTTP session already gave up, so it is raised straight away.
+    Returns the response of the request.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        rate_limiter.acquire()
+        try:
+            return request(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            if e.http_status != 429 or not e.headers or attempt == MAX_ATTEMPTS - 1:
+                raise
+            retry_after = e.headers.get('Retry-After')
+            # The next acquire() waits out the pause, along with the requests of every other thread
+            rate_limiter.pause(float(retry_after) if retry_after else 2 ** attempt)
+
+def map_spotify(request, *iterables):
+    """
+    Make many Spotify API requests concurrently, with at most MAX_WORKERS in flight at once.
+    Returns a list of responses in the same order as the arguments.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(functools.partial(call_spotify, request), *iterables))
+
 def validate_spotify_playlist_url(url):
     """
     Validate the Spotify playlist URL format.
     Returns True if the URL is valid, False otherwise.
     """
-    # Regular expression pattern to match a Spotify playlist URL
-    SPOTIFY_PLAYLIST_REGEX = r'^https://open\.spotify\.com/playlist/[a-zA-Z0-9_-]+\?si=[a-zA-Z0-9_-]+$'
+    return SPOTIFY_PLAYLIST_REGEX.match(url) is not None
+
+def decode_with_orjson(response, *args, **kwargs):
     """
-    Validate the Spotify playlist URL format.
-    Returns True if the URL is valid, False otherwise.
+    Response hook that makes response.json() decode the body with orjson.
+    Returns the same response object.
     """
-    return bool(re.match(SPOTIFY_PLAYLIST_REGEX, url))
+    response.json = lambda **_: orjson.loads(response.content)
+    return response
+
+def create_session():
+    """
+    Create the HTTP session used for Spotify API requests.
+    Its connection pool keeps a connection alive for every worker thread, and transient server errors are retried.
+    Returns a requests Session object.
+    """
+    session = requests.Session()
+    # Rate limiting (HTTP 429) is left to call_spotify(): respect_retry_after_header=False stops urllib3 from retrying
+    # a 429 that carries Retry-After even though 429 is not in status_forcelist
+    # raise_on_status=False hands the last server error back with its real status; otherwise spotipy reports it as a 429
+    retry = Retry(total=SESSION_RETRIES, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504], allowed_methods=frozenset(['GET']),
+                  respect_retry_after_header=False, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, max_retries=retry)
+    session.mount('https://', adapter)
+    if orjson:
+        session.hooks['response'].append(decode_with_orjson)
+    return session
 
 def authenticate_spotify():
     """
@@ -27,52 +159,89 @@ def authenticate_spotify():
     client_secret = os.getenv("CLIENT_SECRET")
 
     client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-    sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+    sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager, requests_session=create_session())
     return sp
 
-def fetch_playlist_tracks(playlist_url):
+def fetch_playlist_tracks(playlist_url, sp):
     """
     Fetch detailed information about tracks in a Spotify playlist using the provided URL.
-    Returns a list of dictionaries, each containing track information.
+    Returns a list of Track objects.
     """
-    sp = authenticate_spotify()
-    playlist_id = playlist_url.split('?')[0].split('/')[-1]  # Split using '?' and extract first part
-    playlist = sp.playlist(playlist_id)
+    playlist_id = SPOTIFY_PLAYLIST_REGEX.match(playlist_url).group(1)
+    playlist = call_spotify(sp.playlist, playlist_id, fields='name,tracks.total')
     print('\n------------ Playlist Name:', playlist['name'])
     track_info = []
 
-    results = sp.playlist_tracks(playlist_id)
-    for item in results['items']:
+    # The track count from the playlist details gives every page offset up front, so all pages are fetched concurrently
+    offsets = range(0, playlist['tracks']['total'], PLAYLIST_PAGE_SIZE)
+    pages = map_spotify(lambda offset: sp.playlist_items(playlist_id, fields=PLAYLIST_ITEM_FIELDS, limit=PLAYLIST_PAGE_SIZE, offset=offset, additional_types=('track',)), offsets)
+
+    for item in (item for page in pages for item in page['items']):
         track = item['track']
-        release_date = track['album']['release_date'] if 'release_date' in track['album'] else None
-        release_year = int(release_date.split('-')[0]) if release_date else None
-        track_info.append({
-            'name': track['name'],
-            'artists': [artist['name'] for artist in track['artists']],
-            'popularity': track['popularity'],
-            'release_year': release_year,
-            'album': track['album']['name'],
-            # add list of genres found in particular track to be used for calculating genre cohension
-        })
+        if not track:  # Skip unavailable tracks and podcast episodes
+            continue
+        release_date = track['album'].get('release_date')
+        release_year = int(release_date.partition('-')[0]) if release_date else None
+        track_info.append(Track(
+            name=track['name'],
+            artists=[artist['name'] for artist in track['artists']],
+            artist_ids=[artist['id'] for artist in track['artists']],
+            popularity=track['popularity'],
+            release_year=release_year,
+            album=track['album']['name'],
+        ))
 
     return track_info
 
-def get_artist_genres(artist_name, sp):
-    results = sp.search(q='artist:' + artist_name, type='artist')
-    if results['artists']['items']:
-        return results['artists']['items'][0]['genres']
-    else:
-        return []
+def fetch_all_artist_genres(artist_ids, sp):
+    """
+    Fetch the genres of several artists by ID, requesting them in batches of ARTIST_BATCH_SIZE.
+    Genres fetched within the last GENRE_CACHE_MAX_AGE seconds are read from the on-disk cache instead.
+    Returns a dictionary mapping each artist ID to its list of genres.
+    """
+    # Drop duplicates and missing IDs (e.g. local files) while keeping the original order
+    artist_ids = [artist_id for artist_id in dict.fromkeys(artist_ids) if artist_id]
+    artist_genres = {}
+    now = time.time()
+
+    with shelve.open(GENRE_CACHE_PATH) as genre_cache:
+        for artist_id in artist_ids:
+            cached = genre_cache.get(artist_id)
+            if cached and now - cached[1] < GENRE_CACHE_MAX_AGE:
+                artist_genres[artist_id] = cached[0]
+
+        missing_ids = [artist_id for artist_id in artist_ids if artist_id not in artist_genres]
+        batches = [missing_ids[i:i + ARTIST_BATCH_SIZE] for i in range(0, len(missing_ids), ARTIST_BATCH_SIZE)]
+
+        for results in map_spotify(sp.artists, batches):
+            for artist in results['artists']:
+                if artist:
+                    artist_genres[artist['id']] = artist['genres']
+                    genre_cache[artist['id']] = (artist['genres'], now)
+
+    return artist_genres
 
 def display_playlist_tracks(track_info):
     """
     Display information for each track.
     """
-    print(f"\n({len(track_info)} tracks) ")
-    for i, track in enumerate(track_info, 1):
-        print(f"{i}. '{track['name']}' - {', '.join(track['artists'])} ({track['album']})")
+    lines = [f"\n({len(track_info)} tracks) "]
+    lines.extend(f"{i}. '{track.name}' - {', '.join(track.artists)} ({track.album})" for i, track in enumerate(track_info, 1))
+    # Write the whole listing at once rather than one print per track
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+def genre_mask(genres, genre_index):
+    """
+    Encode genres as an integer bitmask, using genre_index to map each genre to its bit.
+    Genres not yet in genre_index are given the next free bit.
+    Returns the bitmask.
+    """
+    mask = 0
+    for genre in genres:
+        mask |= 1 << genre_index.setdefault(genre, len(genre_index))
+    return mask
 
-def generate_recommendations(track_info, sp, num_recommendations=10, num_artists_sample=10):
+def generate_recommendations(track_info, artist_genres, sp, num_recommendations=10, num_artists_sample=10):
     """
     Generate recommendations for additional tracks to enhance the playlist.
     Returns a list of recommended track dictionaries.
@@ -81,72 +250,96 @@ def generate_recommendations(track_info, sp, num_recommendations=10, num_artists
     recommendations = []
 
     # Collect unique artists from existing tracks
-    existing_artists = {artist for track in track_info for artist in track['artists']}
+    existing_artists = set(chain.from_iterable(track.artists for track in track_info))
+    existing_artist_ids = set(chain.from_iterable(track.artist_ids for track in track_info)) - {None}
 
-    # Collect genres from existing tracks
-    existing_genres = set()
-    for track in track_info:
-        for artist in track['artists']:
-            existing_genres.update(get_artist_genres(artist, sp))
+    # Collect genres from existing tracks, once per unique artist
+    existing_genres = set().union(*(artist_genres.get(artist_id, ()) for artist_id in existing_artist_ids))
+
+    # Release year of the latest track in the playlist, ignoring tracks without a release date
+    latest_year = max((track.release_year for track in track_info if track.release_year is not None), default=0)
+
+    # Names of the tracks already in the playlist
+    existing_track_names = {track.name for track in track_info}
 
     # Track albums already included in recommendations
     included_albums = set()
 
-    # Iterate over existing artists and find recommendations
-    for artist in existing_artists:
-        # Search for tracks by the artist
-        results = sp.search(q='artist:' + artist, type='track', limit=num_recommendations)
-        for item in results['tracks']['items']:
-            try:
-                # Check if the album and release_date keys exist
-                if 'album' in item and 'release_date' in item['album']:
-                    release_date = item['album']['release_date']
-                    release_year = int(release_date.split('-')[0])
-                    # Filter out tracks released after the latest track in the playlist
-                    if release_year < max(track['release_year'] for track in track_info):
-                        continue
-                else:
-                    # Skip if release_date is missing
-                    continue
-            except KeyError:
-                # Skip if 'album' or 'release_date' keys are missing
+    # Track IDs already considered, since collaborations show up in the top tracks of several seed artists
+    seen_track_ids = set()
+
+    # Sample a few of the existing artists to draw tracks from (sorted first so the population order is stable)
+    seed_artist_ids = random.sample(sorted(existing_artist_ids), min(len(existing_artist_ids), num_artists_sample))
+
+    # Fetch the top tracks of each seed artist concurrently
+    top_tracks_results = map_spotify(sp.artist_top_tracks, seed_artist_ids)
+
+    # Iterate over the top tracks and find recommendations
+    for results in top_tracks_results:
+        for item in results['tracks']:
+            if item['id'] in seen_track_ids:
+                continue
+            seen_track_ids.add(item['id'])
+
+            # Skip if release_date is missing
+            release_date = item['album'].get('release_date')
+            if not release_date:
+                continue
+
+            # Filter out tracks released after the latest track in the playlist
+            release_year = int(release_date.partition('-')[0])
+            if release_year < latest_year:
                 continue
             
             # Filter out tracks already in the playlist
-            if item['name'] in {t['name'] for t in track_info}:
+            if item['name'] in existing_track_names:
                 continue
 
             # Filter out tracks from albums already included in recommendations
             if item['album']['name'] in included_albums:
                 continue
             
-            # Collect genres of the recommended track
-            recommended_genres = set()
-            for artist in item['artists']:
-                recommended_genres.update(get_artist_genres(artist['name'], sp))
-
-            # Calculate the similarity score based on shared genres
-            genre_similarity = len(existing_genres.intersection(recommended_genres)) / len(existing_genres.union(recommended_genres))
-
             recommendations.append({
                 'name': item['name'],
                 'artists': [artist['name'] for artist in item['artists']],
+                'artist_ids': [artist['id'] for artist in item['artists']],
                 'popularity': item['popularity'],
                 'album': item['album']['name'],
                 'release_year': release_year,
-                'genre_similarity': genre_similarity,
+                # Number of the track's artists that are already in the playlist
+                'artist_overlap': len({artist['name'] for artist in item['artists']} & existing_artists),
                 # Add more attributes as needed
             })
 
             # Add the album to the set of included albums
             included_albums.add(item['album']['name'])
 
-    # Sort recommendations by popularity, genre similarity, artist diversity, and album diversity
-    recommendations.sort(key=lambda x: (0.7 * x['popularity'] + 0.3 * x['genre_similarity'] - 0.2 * len(set(x['artists']).intersection(existing_artists)) - 0.1 * len(included_albums)), reverse=True)
+    # Fetch genres for the recommended artists that aren't already in the playlist in one batched pass
+    candidate_artist_ids = {artist_id for x in recommendations for artist_id in x['artist_ids']}
+    genre_lookup = dict(artist_genres)
+    genre_lookup.update(fetch_all_artist_genres(candidate_artist_ids - existing_artist_ids, sp))
+
+    # Compare genre sets as bitmasks, one bit per genre, encoding each artist's genres only once
+    genre_index = {}
+    existing_mask = genre_mask(existing_genres, genre_index)
+    existing_count = existing_mask.bit_count()
+    artist_masks = {artist_id: genre_mask(genre_lookup.get(artist_id, ()), genre_index) for artist_id in candidate_artist_ids}
 
-    return recommendations[:num_recommendations]
+    for recommendation in recommendations:
+        # Collect genres of the recommended track
+        recommended_mask = 0
+        for artist_id in recommendation['artist_ids']:
+            recommended_mask |= artist_masks[artist_id]
 
-def calculate_playlist_ratings(track_info, genre_mapping):
+        # Calculate the similarity score based on shared genres (size of the union is |A| + |B| - |A & B|)
+        shared_count = (existing_mask & recommended_mask).bit_count()
+        recommendation['genre_similarity'] = shared_count / (existing_count + recommended_mask.bit_count() - shared_count)
+
+    # Pick the best recommendations by popularity, genre similarity, and artist diversity
+    # (album diversity is already ensured by keeping at most one track per album)
+    return heapq.nlargest(num_recommendations, recommendations, key=lambda x: (0.7 * x['popularity'] + 0.3 * x['genre_similarity'] - 0.2 * x['artist_overlap']))
+
+def calculate_playlist_ratings(track_info, parent_genre_counts):
     """
     Calculate ratings for the entire playlist based on artist diversity, popularity, genre cohesion, and playlist length.
     Returns the overall rating for the playlist.
@@ -158,15 +351,14 @@ def calculate_playlist_ratings(track_info, genre_mapping):
     LENGTH_WEIGHT = 0.25
 
     # Artist diversity rating
-    unique_artists = set(artist for track in track_info for artist in track['artists'])
+    unique_artists = set(chain.from_iterable(track.artists for track in track_info))
     artist_diversity_rating = min(len(unique_artists) / len(track_info), 1.0)  # Normalize to range between 0 and 1
 
     # Genre cohesion rating
-    genre_cohesion_rating = min(calculate_genre_diversity(track_info, sp, genre_mapping), 1.0)
+    genre_cohesion_rating = min(calculate_genre_diversity(parent_genre_counts), 1.0)
 
     # Popularity rating - better playlists have a good mixture of popular and unpopular tracks
-    popularity_ratings = [track['popularity'] for track in track_info]
-    popularity_rating = min(sum(popularity_ratings) / len(popularity_ratings) / 100, 1.0)  # Normalize to range between 0 and 1
+    popularity_rating = min(sum(track.popularity for track in track_info) / len(track_info) / 100, 1.0)  # Normalize to range between 0 and 1
 
     # Playlist length rating
     playlist_length_rating = min(len(track_info) / 50, 1.0)  # Cap at 1.0 if playlist length exceeds 50 tracks
@@ -185,74 +377,94 @@ def calculate_playlist_ratings(track_info, genre_mapping):
         'overall_rating': overall_rating * 100
     }
 
-def calculate_genre_diversity(track_info, sp, genre_mapping):
+def compile_genre_pattern(genre_mapping):
     """
-    Calculate the diversity rating for parent genres in the playlist.
-    Returns a diversity score between 0.0 and 1.0.
+    Compile a single regular expression that finds the parent genre of a genre in one match.
+    Each parent genre with keywords gets a named group that looks ahead for any of its keywords.
+    The groups are tried in the order of genre_mapping, so the first parent genre with a keyword in the genre wins.
+    Returns the compiled pattern and a dictionary mapping each group name to its parent genre.
     """
-    print('Calculating genre diversity...')
-    
-    all_parent_genres = []
-    total_tracks = len(track_info)
-    
+    group_parent_genres = {}
+    alternatives = []
+    for i, (parent_genre, keywords) in enumerate(genre_mapping.items()):
+        if keywords:
+            group_name = f'parent{i}'
+            group_parent_genres[group_name] = parent_genre
+            alternatives.append(f"(?P<{group_name}>(?=.*?(?:{'|'.join(re.escape(keyword) for keyword in keywords)})))")
+    return re.compile('|'.join(alternatives), re.DOTALL), group_parent_genres
+
+def find_parent_genre(genre, genre_pattern, group_parent_genres):
+    """
+    Find the parent genre of a genre using a pattern from compile_genre_pattern().
+    Returns the parent genre, or None if none of its keywords appear in the genre.
+    """
+    match = genre_pattern.match(genre)
+    return group_parent_genres[match.lastgroup] if match else None
+
+def classify_parent_genres(track_info, artist_genres, genre_mapping):
+    """
+    Classify the genres of every artist on every track into parent genres.
+    Artists without any recognised genre are assigned to 'Miscellaneous/World'.
+    Returns a Counter of parent genres, counting each matched artist genre or unmatched artist.
+    """
+    parent_genre_counts = Counter()
+    genre_pattern, group_parent_genres = compile_genre_pattern(genre_mapping)
+
+    # Parent genre (or None) of every genre classified so far, starting with the keywords themselves
+    # since Spotify often uses them as genres verbatim
+    parent_genre_index = {keyword: find_parent_genre(keyword, genre_pattern, group_parent_genres) for keyword in chain.from_iterable(genre_mapping.values())}
+
     # Iterate through each track in the playlist
     for track in track_info:
-        for artist in track['artists']:
-            artist_genres = get_artist_genres(artist, sp)
-            parent_genres = []
+        for artist_id in track.artist_ids:
+            matched = False
             # Check if each artist genre or its keywords match any parent genre
-            for genre in artist_genres:
-                for parent_genre, keywords in genre_mapping.items():
-                    if any(keyword in genre for keyword in keywords):
-                        parent_genres.append(parent_genre)
-                        break
-            if not parent_genres:  # If no match found, assign to Miscellaneous
-                parent_genres.append('Miscellaneous')
-            all_parent_genres.extend(parent_genres)
+            for genre in artist_genres.get(artist_id, ()):
+                if genre in parent_genre_index:
+                    parent_genre = parent_genre_index[genre]
+                else:
+                    parent_genre = parent_genre_index[genre] = find_parent_genre(genre, genre_pattern, group_parent_genres)
+                if parent_genre:
+                    parent_genre_counts[parent_genre] += 1
+                    matched = True
+            if not matched:  # If no match found, assign to Miscellaneous/World
+                parent_genre_counts['Miscellaneous/World'] += 1
+
+    return parent_genre_counts
+
+def calculate_genre_diversity(parent_genre_counts):
+    """
+    Calculate the diversity rating for parent genres in the playlist from the frequency of each parent genre.
+    Returns a diversity score between 0.0 and 1.0.
+    """
+    print('Calculating genre diversity...')
     
-    # Calculate the frequency of each parent genre
-    parent_genre_counts = Counter(all_parent_genres)
+    total_genres = sum(parent_genre_counts.values())
     
     # Calculate the entropy
-    entropy = 0.0
-    for count in parent_genre_counts.values():
-        probability = count / total_tracks
-        entropy -= probability * math.log(probability, 2)
+    probabilities = [count / total_genres for count in parent_genre_counts.values()]
+    entropy = -sum(probability * math.log2(probability) for probability in probabilities)
     
     # Normalize entropy to a score between 0.0 and 1.0
-    max_entropy = math.log(len(parent_genre_counts), 2)
+    max_entropy = math.log2(len(parent_genre_counts))
     
     # Handle cases where max_entropy is 0
     diversity_score = 1.0 if max_entropy == 0 else 1.0 - (entropy / max_entropy)
     
     return diversity_score
 
-def display_most_popular_genres(track_info, genre_mapping, num_genres=3):
+def display_most_popular_genres(parent_genre_counts, num_genres=3):
     """
     Display the most popular parent genres of the playlist.
     """
-    all_genres = []
-    for track in track_info:
-        for artist in track['artists']:
-            artist_genres = get_artist_genres(artist, sp)
-            parent_genres = []
-            for genre in artist_genres:
-                for parent_genre, keywords in genre_mapping.items():
-                    if any(keyword in genre for keyword in keywords):
-                        parent_genres.append(parent_genre)
-                        break
-            if not parent_genres:
-                parent_genres.append('Miscellaneous/World')
-            all_genres.extend(parent_genres)
-    
-    genre_counts = Counter(all_genres)
-    total_tracks = len(all_genres)
-    most_common_genres = genre_counts.most_common(num_genres)
+    total_tracks = sum(parent_genre_counts.values())
+    most_common_genres = parent_genre_counts.most_common(num_genres)
     
-    print("\nPopular Genres:")
+    lines = ["\nPopular Genres:"]
     for genre, count in most_common_genres:
         percentage = (count / total_tracks) * 100
-        print(f"{genre}: {percentage:.2f}%")
+        lines.append(f"{genre}: {percentage:.2f}%")
+    sys.stdout.write('\n'.join(lines) + '\n')
 
 # Main
 if __name__ == "__main__":
@@ -285,20 +497,25 @@ if __name__ == "__main__":
     print('Authenticating Spotify API...')
     sp = authenticate_spotify()
     print('Fetching playlist information...')
-    track_info = fetch_playlist_tracks(playlist_url)
+    track_info = fetch_playlist_tracks(playlist_url, sp)
+
+    print('Fetching artist genres...')
+    artist_genres = fetch_all_artist_genres(chain.from_iterable(track.artist_ids for track in track_info), sp)
+
+    parent_genre_counts = classify_parent_genres(track_info, artist_genres, genre_mapping)
 
     print('Calculating playlist ratings...')
-    overall_playlist_rating = calculate_playlist_ratings(track_info, genre_mapping)
+    overall_playlist_rating = calculate_playlist_ratings(track_info, parent_genre_counts)
     print()
 
     display_playlist_tracks(track_info)
-    display_most_popular_genres(track_info, genre_mapping)
+    display_most_popular_genres(parent_genre_counts)
     print()
     print('\n------------ Overall Playlist Ratings:')
     for key, value in overall_playlist_rating.items():
         print(f"{key.replace('_', ' ').title()}: {value:.2f}")
 
-    recommendations = generate_recommendations(track_info, sp)
-    print("\n------------ Recommended tracks:")
-    for i, track in enumerate(recommendations, 1):
-        print(f"{i}. '{track['name']}' - {', '.join(track['artists'])} ({track['album']})")
+    recommendations = generate_recommendations(track_info, artist_genres, sp)
+    lines = ["\n------------ Recommended tracks:"]
+    lines.extend(f"{i}. '{track['name']}' - {', '.join(track['artists'])} ({track['album']})" for i, track in enumerate(recommendations, 1))
+    sys.stdout.write('\n'.join(lines) + '\n')